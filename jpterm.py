@@ -1,14 +1,28 @@
 """JMESPath text terminal."""
-import io
 import os
 import sys
 import json
+import math
 import argparse
+import functools
+import threading
+import concurrent.futures
 
 import urwid
 import jmespath
+import jmespath.exceptions
 import pygments.lexers
-import collections
+from pygments.token import Token
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
 
 
 __version__ = '1.1.1'
@@ -30,32 +44,220 @@ OUTPUT_MODES = [
     'expression',
     'quiet',
 ]
+# Seconds of idle time after a keystroke before the expression is
+# evaluated, so a burst of typing results in a single evaluation.
+EDIT_DELAY = 0.15
+# Number of serialized objects kept by JMESPathDisplay._json_dumps.
+DUMPS_CACHE_SIZE = 32
+# Results whose serialized JSON is longer than this many characters
+# don't have their markup cached by _colorize.
+COLORIZE_CACHE_MAX_LENGTH = 64 * 1024
+# Number of lines of the result shown by each Text widget.
+RESULT_CHUNK_LINES = 200
+# Input files larger than this many bytes are parsed incrementally
+# with ijson (when installed with its C backend) instead of being read
+# into memory first.
+# Piped input is always read with the json module since its size isn't
+# known up front.
+STREAMING_THRESHOLD = 64 * 1024 * 1024
+# Looking up a lexer by name scans the installed plugins, so only do
+# it once.  Lexers hold no per-call state and can be shared.
+_JSON_LEXER = pygments.lexers.get_lexer_by_name('json')
+# Font class used for the "JMESPath" banner.
+_FONT_CLS = urwid.get_all_fonts()[-2][1]
+
+
+def _stdlib_dumps(obj, check_non_finite=False):
+    return json.dumps(obj, indent=2, ensure_ascii=False,
+                      separators=(',', ': '))
+
+
+def _has_non_finite_float(obj):
+    stack = [obj]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, float):
+            if not math.isfinite(value):
+                return True
+        elif isinstance(value, dict):
+            stack.extend(value.values())
+        elif isinstance(value, list):
+            stack.extend(value)
+    return False
+
+
+def _orjson_dumps(obj, check_non_finite=False):
+    try:
+        json_string = orjson.dumps(
+            obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS
+        ).decode('utf-8')
+    except TypeError:
+        # orjson is stricter than the json module (e.g. integers
+        # wider than 64 bits), so fall back rather than fail.
+        return _stdlib_dumps(obj)
+    # orjson writes NaN and Infinity as null, whereas the json module
+    # keeps them as they were in the input.  Walking the object is slow
+    # compared to orjson, so callers only ask for it when the object
+    # may contain such values (see _may_produce_non_finite).
+    if check_non_finite and 'null' in json_string and \
+            _has_non_finite_float(obj):
+        return _stdlib_dumps(obj)
+    return json_string
+
+
+# Functions that can compute a new NaN or Infinity from finite input.
+_NON_FINITE_FUNCTIONS = frozenset(['avg', 'sum', 'to_number'])
+
+
+def _may_produce_non_finite(parsed):
+    # Looks at an expression's AST for ways of creating NaN or Infinity
+    # that doesn't come from the input document: arithmetic overflow,
+    # a handful of functions, and literals.
+    stack = [parsed]
+    while stack:
+        node = stack.pop()
+        node_type = node.get('type')
+        if node_type == 'arithmetic':
+            return True
+        if node_type == 'function_expression' and \
+                node.get('value') in _NON_FINITE_FUNCTIONS:
+            return True
+        if node_type == 'literal' and \
+                _has_non_finite_float(node.get('value')):
+            return True
+        stack.extend(child for child in node.get('children', ())
+                     if isinstance(child, dict))
+    return False
+
+
+# orjson is considerably faster at pretty printing large documents,
+# so use it when it's installed.
+_dumps = _orjson_dumps if orjson is not None else _stdlib_dumps
+
+
+def _has_unbalanced_brackets(expression):
+    # A cheap check for the incomplete expressions seen while typing
+    # (e.g. "foo[" before the closing bracket).  Brackets can appear
+    # unbalanced inside literals, so skip the check if there are any.
+    if any(quote in expression for quote in ('"', "'", '`')):
+        return False
+    return (expression.count('[') != expression.count(']') or
+            expression.count('(') != expression.count(')') or
+            expression.count('{') != expression.count('}'))
+
+
+@functools.lru_cache(maxsize=256)
+def _compile(expression):
+    # Typing an expression one character at a time compiles every
+    # prefix along the way, so keep recently parsed expressions around.
+    return jmespath.compile(expression)
 
 
 class ConsoleJSONFormatter(object):
     # We only need to worry about the tokens that can come
     # from lexing JSON.
+    # The values are attribute names registered in
+    # JMESPathDisplay.PALETTE.
     TOKEN_TYPES = {
         # For the values of JSON strings.
-        'Token.Literal.String.Double': urwid.AttrSpec('dark green', 'default'),
-        'Token.Literal.Number.Integer': urwid.AttrSpec('dark blue', 'default'),
-        'Token.Literal.Number.Float': urwid.AttrSpec('dark blue', 'default'),
+        Token.Literal.String.Double: 'json string',
+        Token.Literal.Number.Integer: 'json number',
+        Token.Literal.Number.Float: 'json number',
         # null, true, false
-        'Token.Keyword.Constant': urwid.AttrSpec('light blue', 'default'),
-        'Token.Punctuation': urwid.AttrSpec('light blue', 'default'),
-        'Token.Text': urwid.AttrSpec('white', 'default'),
+        Token.Keyword.Constant: 'json constant',
+        Token.Punctuation: 'json punctuation',
+        Token.Text: 'json text',
         # Key names in a hash.
-        'Token.Name.Tag': urwid.AttrSpec('white', 'default'),
+        Token.Name.Tag: 'json key',
 
     }
     # Used when the token name is not in the list above.
-    DEFAULT_COLOR = urwid.AttrSpec('light blue', 'default'),
-
-    def generate_colors(self, tokens):
-        types = self.TOKEN_TYPES
-        default = self.DEFAULT_COLOR
-        for token_type, token_string in tokens:
-            yield types.get(str(token_type), default), token_string
+    DEFAULT_COLOR = 'json default'
+
+    # Token types are hashable, so they're used as keys directly and
+    # the lookups are bound once rather than resolved for every token.
+    # ``tokens`` are the (index, type, value) triples produced by a
+    # lexer's get_tokens_unprocessed().
+    def generate_colors(self, tokens, _get=TOKEN_TYPES.get,
+                        _default=DEFAULT_COLOR):
+        return ((_get(token_type, _default), token_string)
+                for _, token_type, token_string in tokens)
+
+
+_JSON_FORMATTER = ConsoleJSONFormatter()
+
+
+def _generate_markup(json_string):
+    # Serialized JSON needs none of the input normalization done by
+    # get_tokens(), so use the lexer's raw token stream.
+    tokens = _JSON_LEXER.get_tokens_unprocessed(json_string)
+    return list(_JSON_FORMATTER.generate_colors(tokens))
+
+
+_generate_markup_cached = functools.lru_cache(maxsize=32)(_generate_markup)
+
+
+def _colorize(json_string):
+    # Editing often goes back to an earlier result (backspacing and
+    # retyping part of an expression), so reuse its markup.  Markup
+    # takes many times the memory of its JSON text, so large results
+    # aren't cached.
+    if len(json_string) > COLORIZE_CACHE_MAX_LENGTH:
+        return _generate_markup(json_string)
+    return _generate_markup_cached(json_string)
+
+
+def _is_number_array(value):
+    # bool is a subclass of int, so compare the exact types.
+    return (isinstance(value, list) and len(value) > 0 and
+            all(type(item) in (int, float) for item in value))
+
+
+def _colorize_number_array(json_string):
+    # Flat arrays of numbers are common query results and have a
+    # fixed layout (one number per line), so build the markup directly
+    # instead of running the lexer over every element.
+    types = ConsoleJSONFormatter.TOKEN_TYPES
+    punctuation = types[Token.Punctuation]
+    number = types[Token.Literal.Number.Integer]
+    whitespace = ConsoleJSONFormatter.DEFAULT_COLOR
+    lines = json_string.split('\n')
+    markup = [(punctuation, lines[0])]
+    for line in lines[1:-1]:
+        value = line.lstrip()
+        markup.append((whitespace, '\n' + line[:len(line) - len(value)]))
+        if value.endswith(','):
+            markup.append((number, value[:-1]))
+            markup.append((punctuation, ','))
+        else:
+            markup.append((number, value))
+    markup.append((whitespace, '\n'))
+    markup.append((punctuation, lines[-1]))
+    return markup
+
+
+def _split_markup_lines(markup, max_lines):
+    # Split text markup into lists of at most max_lines lines each.  The
+    # newline between two chunks is dropped since each chunk is its own
+    # widget.
+    chunks = []
+    current = []
+    lines = 0
+    for attr, text in markup:
+        for i, part in enumerate(text.split('\n')):
+            if i > 0:
+                lines += 1
+                if lines >= max_lines:
+                    chunks.append(current)
+                    current = []
+                    lines = 0
+                else:
+                    current.append((attr, '\n'))
+            if part:
+                current.append((attr, part))
+    if current:
+        chunks.append(current)
+    return chunks
 
 
 class JMESPathDisplay(object):
@@ -63,24 +265,52 @@ class JMESPathDisplay(object):
     PALETTE = [
         ('input expr', 'black,bold', 'light gray'),
         ('bigtext', 'white', 'black'),
+        # Colors for the tokens of highlighted JSON, see
+        # ConsoleJSONFormatter.TOKEN_TYPES.
+        ('json string', 'dark green', 'default'),
+        ('json number', 'dark blue', 'default'),
+        ('json constant', 'light blue', 'default'),
+        ('json punctuation', 'light blue', 'default'),
+        ('json text', 'white', 'default'),
+        ('json key', 'white', 'default'),
+        ('json default', 'light blue', 'default'),
     ]
 
-    def __init__(self, input_data, output_mode='result'):
+    def __init__(self, input_data, output_mode='result',
+                 input_has_non_finite=False):
         self.view = None
+        self.loop = None
+        self._pending_alarm = None
         self.parsed_json = input_data
-        self.lexer = pygments.lexers.get_lexer_by_name('json')
-        self.formatter = ConsoleJSONFormatter()
+        # Whether input_data holds NaN or Infinity values.
+        self._input_has_non_finite = input_has_non_finite
+        self._input_json_string = None
+        self._input_markup = None
         self.output_mode = output_mode
         self.last_result = None
+        self.last_result_string = None
+        # The serialized JSON currently shown in the result panel.
+        self._rendered_json_string = None
+        self._dumps_cache = {}
+        self._dumps_lock = threading.Lock()
         self.last_expression = None
+        # Plain dicts keep insertion order, so they retain the key
+        # order from the expression just like OrderedDict did.
+        self._jmes_options = jmespath.Options(dict_cls=dict)
+        # Expressions that failed to compile since the last one that
+        # compiled, so retyping them doesn't parse them again.
+        self._bad_expressions = set()
+        # Searching, serializing and colorizing the result happen on a
+        # worker thread so a slow query doesn't block typing.
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._search_future = None
+        self._search_done_fd = None
 
     def _create_colorized_json(self, json_string):
-        tokens = self.lexer.get_tokens(json_string)
-        markup = list(self.formatter.generate_colors(tokens))
-        return markup
+        return _colorize(json_string)
 
     def _get_font_instance(self):
-        return urwid.get_all_fonts()[-2][1]()
+        return _FONT_CLS()
 
     def _create_view(self):
         self.input_expr = urwid.Edit(('input expr', "JMESPath Expression: "))
@@ -98,16 +328,15 @@ class JMESPathDisplay(object):
             focus_item=2)
         urwid.connect_signal(self.input_expr, 'change', self._on_edit)
 
-        self.input_json = urwid.Text(
-            self._create_colorized_json(self._json_dumps(self.parsed_json))
-        )
+        # Colorizing the input document can take a while for large
+        # inputs, so show a placeholder until the main loop is running.
+        self.input_json = urwid.Text("Loading...")
         self.input_json_list = [div, self.input_json]
         self.left_content = urwid.ListBox(self.input_json_list)
         self.left_content = urwid.LineBox(self.left_content,
                                           title='Input JSON')
 
-        self.jmespath_result = urwid.Text("")
-        self.jmespath_result_list = [div, self.jmespath_result]
+        self.jmespath_result_list = urwid.SimpleFocusListWalker([div])
         self.right_content = urwid.ListBox(self.jmespath_result_list)
         self.right_content = urwid.LineBox(self.right_content,
                                            title='JMESPath Result')
@@ -118,37 +347,189 @@ class JMESPathDisplay(object):
         self.view = urwid.Frame(body=self.content, header=self.header,
                                 footer=self.footer, focus_part='header')
 
+    def _get_input_json_string(self):
+        if self._input_json_string is None:
+            self._input_json_string = self._json_dumps(
+                self.parsed_json, self._input_has_non_finite)
+        return self._input_json_string
+
+    def _render_input_json(self, loop, user_data):
+        if self._input_markup is None:
+            # A due alarm runs before the loop's first redraw, so paint
+            # the placeholder explicitly before doing the slow part.
+            loop.draw_screen()
+            # The markup is kept in _input_markup, so it doesn't need
+            # to take up a slot in the result markup cache.
+            self._input_markup = _generate_markup(
+                self._get_input_json_string())
+        self.input_json.set_text(self._input_markup)
+
     def _on_edit(self, widget, text):
+        if self._pending_alarm is not None:
+            self.loop.remove_alarm(self._pending_alarm)
+        self._pending_alarm = self.loop.set_alarm_in(
+            EDIT_DELAY, self._on_edit_idle, text)
+
+    def _on_edit_idle(self, loop, text):
+        self._pending_alarm = None
+        self._run_query(text)
+
+    def _flush_pending_edit(self):
+        # Evaluate any expression still waiting on the edit delay, or
+        # still being searched, so exiting right after a keystroke
+        # doesn't lose it.
+        if self._pending_alarm is not None:
+            self.loop.remove_alarm(self._pending_alarm)
+            self._pending_alarm = None
+            self._run_query(self.input_expr.edit_text)
+        self._wait_for_search()
+
+    def _clear_expression(self):
+        # Reset the expression without emitting a change signal, which
+        # would otherwise schedule a pointless evaluation of ''.
+        urwid.disconnect_signal(self.input_expr, 'change', self._on_edit)
+        self.input_expr.set_edit_text('')
+        urwid.connect_signal(self.input_expr, 'change', self._on_edit)
+        if self._pending_alarm is not None:
+            self.loop.remove_alarm(self._pending_alarm)
+            self._pending_alarm = None
+        self._run_query('')
+
+    def _run_query(self, text):
         self.last_expression = text
         if not text:
             # If a user has hit backspace until there's no expression
             # left, we can exit early and just clear the result text
             # panel.
-            self.jmespath_result.set_text('')
+            self._cancel_search()
+            self._set_result_chunks([])
+            self._rendered_json_string = None
+            return
+        if _has_unbalanced_brackets(text) or text in self._bad_expressions:
             return
         try:
-            options = jmespath.Options(dict_cls=collections.OrderedDict)
-            result = jmespath.compile(text).search(self.parsed_json, options)
-            self.footer.set_text("Status: success")
-        except Exception:
-            pass
+            expression = _compile(text)
+        except jmespath.exceptions.JMESPathError:
+            self._bad_expressions.add(text)
+            return
+        self._bad_expressions.clear()
+        # Only the latest expression matters, drop any older search
+        # that hasn't started yet.
+        self._cancel_search()
+        self._search_future = self._executor.submit(self._search, expression)
+        self._search_future.add_done_callback(self._notify_search_done)
+
+    def _cancel_search(self):
+        if self._search_future is not None:
+            self._search_future.cancel()
+            self._search_future = None
+
+    def _search(self, expression):
+        # Runs on the worker thread, so it mustn't touch any widgets.
+        result = expression.search(self.parsed_json, self._jmes_options)
+        if result is None:
+            return result, None, None
+        json_string = self._json_dumps(
+            result, self._input_has_non_finite or
+            _may_produce_non_finite(expression.parsed))
+        if json_string == self._rendered_json_string:
+            # Different expressions often give the same result (e.g.
+            # while typing whitespace), which is already on screen.
+            return result, json_string, None
+        return result, json_string, self._colorize_result(result,
+                                                          json_string)
+
+    def _colorize_result(self, result, json_string):
+        # Returns the markup already split into the chunks shown by
+        # each Text widget, since splitting a large result is slow
+        # enough that it belongs on the worker thread too.
+        if _is_number_array(result):
+            markup = _colorize_number_array(json_string)
         else:
-            if result is not None:
-                self.last_result = result
-                result_markup = self._create_colorized_json(
-                    self._json_dumps(result))
-                self.jmespath_result.set_text(result_markup)
-
-    def _json_dumps(self, obj):
-        return json.dumps(obj, indent=2, ensure_ascii=False)
+            markup = self._create_colorized_json(json_string)
+        return _split_markup_lines(markup, RESULT_CHUNK_LINES)
+
+    def _notify_search_done(self, future):
+        # Called from the worker thread; wake up the main loop, which
+        # picks up the result in _on_search_done.
+        os.write(self._search_done_fd, b'\n')
+
+    def _on_search_done(self, data):
+        future = self._search_future
+        if future is not None and future.done():
+            self._search_future = None
+            self._apply_search_future(future)
+        return True
+
+    def _wait_for_search(self):
+        future = self._search_future
+        if future is not None:
+            self._search_future = None
+            concurrent.futures.wait([future])
+            self._apply_search_future(future)
+
+    def _apply_search_future(self, future):
+        if future.cancelled():
+            return
+        try:
+            search_result = future.result()
+        except Exception:
+            # Besides JMESPathError, evaluation can fail with plain
+            # Python errors such as ZeroDivisionError.
+            return
+        self._update_result(*search_result)
+
+    def _update_result(self, result, json_string, result_chunks):
+        self.footer.set_text("Status: success")
+        if result is not None:
+            self.last_result = result
+            self.last_result_string = json_string
+            if json_string == self._rendered_json_string:
+                return
+            if result_chunks is None:
+                # The panel was cleared after the search was started.
+                result_chunks = self._colorize_result(result, json_string)
+            self._set_result_chunks(result_chunks)
+            self._rendered_json_string = json_string
+
+    def _set_result_chunks(self, chunks):
+        # Large results are split across several Text widgets so the
+        # ListBox only has to render the chunks that are on screen.
+        self.jmespath_result_list[1:] = [urwid.Text(chunk)
+                                         for chunk in chunks]
+        self.jmespath_result_list.set_focus(0)
+
+    def _json_dumps(self, obj, check_non_finite=False):
+        # Results are frequently the very same object as before (e.g.
+        # a subtree of the input), so serialize each object only once.
+        # The object is kept alongside its string so that its id can't
+        # be reused by another object while the entry is cached.
+        key = id(obj)
+        with self._dumps_lock:
+            cached = self._dumps_cache.get(key)
+        if cached is not None and cached[0] is obj:
+            return cached[1]
+        json_string = _dumps(obj, check_non_finite)
+        with self._dumps_lock:
+            if len(self._dumps_cache) >= DUMPS_CACHE_SIZE:
+                del self._dumps_cache[next(iter(self._dumps_cache))]
+            self._dumps_cache[key] = (obj, json_string)
+        return json_string
 
     def main(self, screen=None):
         self._create_view()
         self.loop = urwid.MainLoop(self.view, self.PALETTE,
                                    unhandled_input=self.unhandled_input,
                                    screen=screen)
+        self.loop.set_alarm_in(0, self._render_input_json)
+        self._search_done_fd = self.loop.watch_pipe(self._on_search_done)
         self.loop.screen.set_terminal_properties(colors=256)
-        self.loop.run()
+        try:
+            self.loop.run()
+        finally:
+            # Runs for both F5 and Ctrl-C (KeyboardInterrupt).
+            self._flush_pending_edit()
+            self._executor.shutdown(wait=False)
 
     def unhandled_input(self, key):
         if key == 'f5':
@@ -158,8 +539,7 @@ class JMESPathDisplay(object):
             # currently entered expression.  Avoids
             # having to hold backspace to delete
             # the current expression current expression.
-            self.input_expr.edit_text = ''
-            self.jmespath_result.set_text('')
+            self._clear_expression()
         elif key == 'ctrl p':
             new_mode = OUTPUT_MODES[
                 (OUTPUT_MODES.index(self.output_mode) + 1) % len(OUTPUT_MODES)]
@@ -169,7 +549,7 @@ class JMESPathDisplay(object):
     def display_output(self, filename):
         if self.output_mode == 'result' and \
                 self.last_result is not None:
-            result = self._json_dumps(self.last_result)
+            result = self.last_result_string
         elif self.output_mode == 'expression' and \
                 self.last_expression is not None:
             result = self.last_expression
@@ -188,35 +568,56 @@ def _load_json_from_pipe():
     # stdin and then reset stdin this back to the controlling tty.
     # Replace fd(0) with tty instead of modifying sys.stdin.
     # See https://github.com/python/cpython/issues/36029#issuecomment-1093968541 # noqa
-    buf = io.BytesIO()
     fd = sys.stdin.fileno()
     stdin = os.dup(fd)
     os.close(fd)
     os.open(os.ctermid(), os.O_RDONLY)
-    while True:
-        bs = os.read(stdin, 2**32)
-        if not bs:
-            break
-        buf.write(bs)
-    buf.seek(0)
-    input_json = json.loads(buf.read().decode())
-    buf.close()
-    return input_json
+    # Read through a buffered file object instead of collecting the
+    # payload in a BytesIO and decoding it separately.  json.load still
+    # reads the whole raw text before parsing it.
+    with os.fdopen(stdin, 'rb', buffering=1 << 20) as f:
+        return _json_load(f)
+
+
+def _json_load(f, streaming=False):
+    # Returns the document and whether it contained NaN or Infinity.
+    if streaming and ijson is not None and ijson.backend == 'yajl2_c':
+        # ijson builds the document straight from the file, so the
+        # full JSON text never has to be held in memory alongside it.
+        # Its pure Python backends are much slower than the json
+        # module though, so only the C one is used.
+        try:
+            values = list(ijson.items(f, '', use_float=True))
+        except ijson.JSONError:
+            # ijson is stricter than the json module (e.g. it rejects
+            # NaN, integers wider than 64 bits and a UTF-8 BOM), so
+            # leave the verdict on the input to json.load.
+            f.seek(0)
+        else:
+            return values[0], False
+    non_finite = []
+
+    def parse_constant(name):
+        non_finite.append(name)
+        return float(name)
+
+    input_json = json.load(f, parse_constant=parse_constant)
+    return input_json, bool(non_finite)
 
 
 def _load_input_json(filename):
     if filename is not None:
-        with open(filename) as f:
-            input_json = json.load(f)
+        with open(filename, 'rb') as f:
+            streaming = os.fstat(f.fileno()).st_size > STREAMING_THRESHOLD
+            return _json_load(f, streaming)
     elif not os.isatty(sys.stdin.fileno()):
-        input_json = _load_json_from_pipe()
+        return _load_json_from_pipe()
     else:
         # If the user didn't provide a filename,
         # we want to be helpful so we'll use a sample
         # document so they can still try out the
         # JMESPath Terminal.
-        input_json = SAMPLE_JSON
-    return input_json
+        return SAMPLE_JSON, False
 
 
 def main():
@@ -242,13 +643,15 @@ def main():
 
     args = parser.parse_args()
     try:
-        input_json = _load_input_json(getattr(args, 'input-json', None))
+        input_json, input_has_non_finite = _load_input_json(
+            getattr(args, 'input-json', None))
     except ValueError as e:
         sys.stderr.write("Unable to load the input JSON: %s\n\n" % e)
         return 1
 
     screen = urwid.raw_display.Screen()
-    display = JMESPathDisplay(input_json, args.output_mode)
+    display = JMESPathDisplay(input_json, args.output_mode,
+                              input_has_non_finite)
     try:
         display.main(screen=screen)
     except KeyboardInterrupt:
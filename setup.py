@@ -22,6 +22,10 @@ setup(
     scripts=['bin/jpterm'],
     py_modules=['jpterm'],
     install_requires=requires,
+    extras_require={
+        'orjson': ['orjson'],
+        'ijson': ['ijson>=3.1'],
+    },
     classifiers=(
         'Development Status :: 5 - Production/Stable',
         'Intended Audience :: Developers',